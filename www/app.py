@@ -1,10 +1,12 @@
 import logging
 
-import asyncio, json, orm, os, time, datetime
+import asyncio, json, orm, os, signal, time, datetime
+import counters, executor, feed, idgen, profiler, rendering, search, warmup
 from coroweb import add_routes, add_static
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
+from config import configs
 from handlers import cookie2user, COOKIE_NAME
 
 logging.basicConfig(level = logging.INFO)
@@ -33,8 +35,9 @@ def init_jinja2(app, **kw):
 
 # middleware是一种拦截器，一个url在被某个函数处理前，可以经过一系列的middleware的处理
 # 一个middleware可以改变url的输入，输出，甚至可以决定不继续处理而直接返回，起作用在于把通用的功能从每个url处理函数中拿出来，集中放到一个地方。例如一个记录url日志的logger
-# TODO: 可以按照标准简化
-async def logger_factrory(app, handler):
+# middleware不再交给aiohttp在每个请求时动态组装，而是在add_route时按route的声明(auth/raw)组装成固定的handler链
+# 所以这里的factory都是普通函数，见coroweb.build_handler
+def logger_factrory(app, handler):
     async def logger(request):
         # 记录日志
         logging.info('app.py: Request: %s %s' %(request.method, request.path))
@@ -42,7 +45,7 @@ async def logger_factrory(app, handler):
     return logger
 
 ###定义middle在处理URL之前，把cookie解析出来，并将登陆用户绑定到request对象上，这样，后续的URL处理函数就可以直接拿到登陆用户
-async def auth_factory(app, handler):
+def auth_factory(app, handler):
     async def auth(request):
         logging.info('app.py: check user:%s %s' %(request.method, request.path))
         request.__user__ = None
@@ -59,7 +62,19 @@ async def auth_factory(app, handler):
     return auth
 
 
-async def response_factory(app, handler):
+def json_default(o):
+    # orm.Row没有__dict__
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    return o.__dict__
+
+def dumps_json(r):
+    return json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8')
+
+def render_template(template, r):
+    return template.render(**r).encode('utf-8')
+
+def response_factory(app, handler):
     async def response(request):
         logging.info('app.py: Response handler...')
         r = await handler(request)
@@ -77,13 +92,16 @@ async def response_factory(app, handler):
             return resp
         if isinstance(r, dict):
             template = r.get('__template__')
+            # 结果较大时序列化/渲染放到线程池，不阻塞事件循环
+            size = executor.estimate_size(r)
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=await executor.run(dumps_json, r, size=size, picklable=False))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
-                r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                r['__user__'] = getattr(request, '__user__', None)
+                body = await executor.run(render_template, app['__templating__'].get_template(template), r, size=size, picklable=False)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -108,23 +126,53 @@ def datetime_filter(t):
         return '%s小时前' % (delta // 3600)
     if delta < 604800:
         return '%s天前' % (delta // 86400)
-    dt = datetime.fromtimestamp(t)
+    return date_filter(t)
+
+# 不随时间变化的日期，用于会被缓存的片段
+def date_filter(t):
+    dt = datetime.datetime.fromtimestamp(t)
     return '%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
 # 把一个generator标记为coroutine类型，然后把这个coroutine扔到Eventloop中执行
-async def init(loop):
-    await orm.create_pool(loop=loop, user='root', password='password', db='webapp')
-    app = web.Application(loop=loop, middlewares=[logger_factrory, auth_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+# backend: 替换MySQL的数据库后端，例如bench.py使用的sqlite_backend.SQLiteBackend
+async def init(loop, host='127.0.0.1', port=9001, backend=None):
+    if backend is None:
+        await orm.create_pool(loop=loop, user='root', password='password', db='webapp')
+    else:
+        orm.use_backend(backend)
+    idgen.init(**configs.id)
+    app = web.Application(loop=loop)
+    profiler.init(app, loop, **configs.profile)
+    executor.init(app, **configs.executor)
+    # 顺序：第一个在最外层。静态文件不经过任何middleware
+    app['__middlewares__'] = [('logger', logger_factrory), ('profile', profiler.profile_factory), ('auth', auth_factory), ('response', response_factory)]
+    init_jinja2(app, filters=dict(datetime=datetime_filter, date=date_filter))
     add_routes(app, 'handlers')
     add_static(app)
-    srv = await loop.create_server(app._make_handler(), '127.0.0.1', 9001)
-    logging.info('app.py: Server started at http://127.0.0.1:9001...')
-    return srv
+    rendering.init(**configs.render)
+    await search.init(app, **configs.search)
+    await feed.init(app, **configs.feed)
+    await counters.init(app, **configs.counters)
+    await warmup.run(app, pool_size=configs.warmup.pool_size, routes=configs.warmup.routes)
+    srv = await loop.create_server(app._make_handler(), host, port)
+    logging.info('app.py: Server started at http://%s:%s...' % (host, port))
+    app['__server__'] = srv
+    return app
 
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(init(loop))
-    loop.run_forever()
+    app = loop.run_until_complete(init(loop))
+    # 先让/readyz返回503，等负载均衡摘掉流量后再停止
+    def drain():
+        app['__ready__'] = False
+        loop.call_later(configs.warmup.drain, loop.stop)
+    loop.add_signal_handler(signal.SIGTERM, drain)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 触发on_shutdown，保存搜索索引快照等
+        loop.run_until_complete(app.shutdown())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark the app end to end over HTTP, without MySQL.
+
+Starts app.init() on an in-memory SQLite backend, seeds users, blogs and comments, then drives
+each scenario at every concurrency level and reports throughput and p50/p95/p99 latency.
+
+    python3 bench.py --save baseline.json
+    python3 bench.py --compare baseline.json     # exit 1 on regression
+'''
+
+import argparse, asyncio, hashlib, json, logging, os, platform, random, sys, tempfile, time
+
+import aiohttp
+
+import app as webapp
+import orm
+from config import configs
+from models import User, Blog, Comment, RenderedContent, next_id
+from sqlite_backend import SQLiteBackend
+
+BENCH_EMAIL = 'bench0@example.com'
+BENCH_PASSWORD = 'password'
+
+def _row(obj):
+    'insert args of obj, in the order of Model.__insert__'
+    args = list(map(obj.getValueOrDefault, obj.__fields__))
+    args.append(obj.getValueOrDefault(obj.__primary_key__))
+    return args
+
+async def seed(backend, users, blogs, comments):
+    '''
+    Insert rows directly through the backend, bypassing Model listeners. Return the blog ids.
+    '''
+    now = time.time()
+    user_rows = []
+    for n in range(users):
+        uid = next_id()
+        email = 'bench%d@example.com' % n
+        # 和浏览器端一样先做一次sha1(email:password)
+        client = hashlib.sha1(('%s:%s' % (email, BENCH_PASSWORD)).encode('utf-8')).hexdigest()
+        passwd = hashlib.sha1(('%s:%s' % (uid, client)).encode('utf-8')).hexdigest()
+        user_rows.append(User(id=uid, salt=str(uid), email=email, passwd=passwd, admin=(n == 0), name='bench%d' % n,
+                              image='about:blank', created_at=now - random.random() * 86400 * 365))
+    await backend.executemany(User.__insert__, [_row(u) for u in user_rows])
+    blog_rows = []
+    for n in range(blogs):
+        u = random.choice(user_rows)
+        blog_rows.append(Blog(id=next_id(), user_id=u.id, user_name=u.name, user_image=u.image, name='Blog %d' % n,
+                              summary='summary of blog %d' % n, content=('第%d篇日志 lorem ipsum dolor sit amet.\n' % n) * 50,
+                              created_at=now - random.random() * 86400 * 365))
+    await backend.executemany(Blog.__insert__, [_row(b) for b in blog_rows])
+    comment_rows = []
+    for n in range(comments):
+        u = random.choice(user_rows)
+        b = random.choice(blog_rows)
+        comment_rows.append(Comment(id=next_id(), blog_id=b.id, user_id=u.id, user_name=u.name, user_image=u.image,
+                                    content='comment %d' % n, created_at=b.created_at + random.random() * 86400))
+    await backend.executemany(Comment.__insert__, [_row(c) for c in comment_rows])
+    logging.info('bench.py: seeded %s users, %s blogs, %s comments' % (users, blogs, comments))
+    return [b.id for b in blog_rows]
+
+def scenarios(blog_ids):
+    '''
+    (name, method, path factory, json body)
+    '''
+    client = hashlib.sha1(('%s:%s' % (BENCH_EMAIL, BENCH_PASSWORD)).encode('utf-8')).hexdigest()
+    return [
+        ('GET /', 'GET', lambda: '/', None),
+        ('GET /api/blogs', 'GET', lambda: '/api/blogs?page=%d' % random.randint(1, 5), None),
+        ('GET /api/blogs/{id}', 'GET', lambda: '/api/blogs/%s' % random.choice(blog_ids), None),
+        ('POST /api/authenticate', 'POST', lambda: '/api/authenticate', dict(email=BENCH_EMAIL, passwd=client))
+    ]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+async def drive(session, base, method, path, body, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = [total]
+
+    async def worker():
+        nonlocal errors
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                async with session.request(method, base + path(), json=body) as resp:
+                    await resp.read()
+                    if resp.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return dict(
+        requests=total,
+        errors=errors,
+        rps=round(total / elapsed, 1),
+        p50=round(percentile(latencies, 50) * 1000, 3),
+        p95=round(percentile(latencies, 95) * 1000, 3),
+        p99=round(percentile(latencies, 99) * 1000, 3)
+    )
+
+async def run(loop, args):
+    backend = SQLiteBackend()
+    backend.create_tables(User, Blog, Comment, RenderedContent)
+    orm.use_backend(backend)
+    blog_ids = await seed(backend, args.users, args.blogs, args.comments)
+    # 不要读写正式环境的搜索索引快照
+    configs.search.snapshot = os.path.join(tempfile.mkdtemp(), 'search.idx')
+    app = await webapp.init(loop, port=args.port, backend=backend)
+    base = 'http://127.0.0.1:%s' % args.port
+    results = dict()
+    try:
+        async with aiohttp.ClientSession() as session:
+            for name, method, path, body in scenarios(blog_ids):
+                for concurrency in args.concurrency:
+                    key = '%s @%s' % (name, concurrency)
+                    r = results[key] = await drive(session, base, method, path, body, concurrency, args.requests)
+                    print('%-36s %9.1f req/s  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  errors %s' % (key, r['rps'], r['p50'], r['p95'], r['p99'], r['errors']))
+    finally:
+        app['__server__'].close()
+        await app.shutdown()
+    return dict(
+        meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(), users=args.users,
+                  blogs=args.blogs, comments=args.comments, requests=args.requests),
+        results=results
+    )
+
+def compare(baseline, current, threshold):
+    '''
+    Print the change of every result against baseline, return the number of regressions.
+    '''
+    regressions = 0
+    for key, r in sorted(current['results'].items()):
+        b = baseline['results'].get(key)
+        if b is None:
+            continue
+        rps = (r['rps'] - b['rps']) / b['rps'] if b['rps'] else 0.0
+        p99 = (r['p99'] - b['p99']) / b['p99'] if b['p99'] else 0.0
+        bad = rps < -threshold or p99 > threshold
+        if bad:
+            regressions += 1
+        print('%-36s rps %+7.1f%%  p99 %+7.1f%%%s' % (key, rps * 100, p99 * 100, '  REGRESSION' if bad else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the webapp on an in-memory SQLite database.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--blogs', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario and concurrency level')
+    parser.add_argument('--concurrency', type=lambda s: [int(c) for c in s.split(',')], default=[1, 10, 50])
+    parser.add_argument('--port', type=int, default=9101)
+    parser.add_argument('--save', help='write results as json baseline')
+    parser.add_argument('--compare', help='compare with a json baseline, exit 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative change, default 0.1')
+    args = parser.parse_args()
+    # 请求日志会严重影响结果
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(0)
+    loop = asyncio.get_event_loop()
+    current = loop.run_until_complete(run(loop, args))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Small in-process caches.
+'''
+
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    Least recently used cache. The total sizeof(value) of all entries is kept within maxsize,
+    by default every entry has size 1 so maxsize is the number of entries. With ttl, entries
+    older than ttl seconds are treated as missing.
+    '''
+    def __init__(self, maxsize=1000, sizeof=None, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._sizeof = sizeof or (lambda value: 1)
+        self._data = OrderedDict()   # key -> (value, size, expires)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value, size, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        size = self._sizeof(value)
+        self.pop(key)
+        # 单个值比整个缓存还大，不缓存
+        if size > self.maxsize:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, size, expires)
+        self.size += size
+        while self.size > self.maxsize:
+            k, (v, s, e) = self._data.popitem(last=False)
+            self.size -= s
+
+    def pop(self, key, default=None):
+        try:
+            value, size, expires = self._data.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def __str__(self):
+        return 'LRUCache(entries: %s, size: %s/%s, hits: %s, misses: %s)' % (len(self._data), self.size, self.maxsize, self.hits, self.misses)
+    __repr__ = __str__
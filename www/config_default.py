@@ -10,5 +10,52 @@ configs = {
     },
     'session':{
         'secret': 'WeBaPp'
+    },
+    'id':{
+        'worker': None,     # 0..31, None: claim a free one with a lock file in lock_dir
+        'lock_dir': None
+    },
+    'blogs':{
+        'list_ttl': 10,     # seconds the blog count and latest blogs are cached
+        'page_ttl': 30      # seconds a rendered blog page with its first comments is cached
+    },
+    'search':{
+        'snapshot': None,   # None: www/data/search.idx
+        'interval': 60      # seconds between snapshots
+    },
+    'render':{
+        'cache_size': 16 * 1024 * 1024,   # total chars of cached html
+        'persist': False                  # store html in table rendered_content
+    },
+    'counters':{
+        'interval': 10,         # seconds between flushes of pending increments
+        'cache_size': 10000,    # stored counts kept in memory
+        'ttl': 60               # seconds before a stored count is read again
+    },
+    'warmup':{
+        'pool_size': 5,         # connections opened before serving
+        'routes': True,         # send a synthetic request through every GET route
+        'drain': 5              # seconds between SIGTERM and stop, /readyz returns 503 meanwhile
+    },
+    'executor':{
+        'kind': 'process',      # pool for picklable work (markdown, hashing): thread or process
+        'threads': 4,
+        'processes': 2,
+        'threshold': 32 * 1024  # payload size from which work leaves the event loop
+    },
+    'feed':{
+        'title': 'Awesome Python Webapp',
+        'link': 'http://127.0.0.1:9001',
+        'description': '',
+        'size': 20,
+        'interval': 60      # seconds between reloads, picks up blogs changed by other processes
+    },
+    'profile':{
+        'rate': 0.0,            # fraction of requests to profile
+        'secret': None,         # key of signed X-Profile header, see profiler.sign()
+        'dir': None,            # None: www/data/profiles
+        'keep': 50,
+        'lag_interval': 0.1,
+        'lag_threshold': 0.5    # seconds, None disables the loop monitor
     }
 }
\ No newline at end of file
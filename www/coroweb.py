@@ -1,4 +1,4 @@
-import functools, logging, os
+import functools, json, logging, os
 import asyncio, inspect
 from aiohttp import web
 from urllib import parse
@@ -6,9 +6,11 @@ from apis import APIError
 
 
 # 把一个函数映射为一个URL处理函数
-def get(path):
+def get(path, *, auth=True, raw=False):
     '''
     Define decorator @get('/path')
+    auth=False: skip the auth middleware (no cookie parsing, request.__user__ is None)
+    raw=True: handler returns a web.StreamResponse itself, skip response_factory
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -16,10 +18,12 @@ def get(path):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__auth__ = auth
+        wrapper.__raw__ = raw
         return wrapper
     return decorator
 
-def post(path):
+def post(path, *, auth=True, raw=False):
     '''
     Define decorator @post('/post')
     '''
@@ -29,6 +33,8 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__auth__ = auth
+        wrapper.__raw__ = raw
         return wrapper
     return decorator
 
@@ -81,9 +87,10 @@ class RequestHandler(object):
     '''
     Define request Handler class for different requests
     '''
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, raw=False):
         self._app = app
         self._func = fn
+        self._raw = raw   # raw route: no response_factory behind us
         self._has_request_arg = has_request_arg(fn)
         self._has_var_kw_arg = has_var_kw_arg(fn)   # **kwargs
         self._has_named_kw_args = has_named_kw_arg(fn)   # Parameter after * & *args
@@ -143,22 +150,52 @@ class RequestHandler(object):
             r = await self._func(**kw)
             return r
         except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+            r = dict(error=e.error, data=e.data, message=e.message)
+            if self._raw:
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False).encode('utf-8'))
+                resp.content_type = 'application/json;charset=utf-8'
+                return resp
+            return r
 
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     app.router.add_static('/static/', path)
     logging.info('add static %s => %s' % ('/static/', path))
 
-def add_route(app, fn):
+# 每个route在启动时根据自己需要的中间件生成专属的handler链，
+# 不需要的阶段（auth/response）直接跳过，而不是每个请求都走一遍所有middleware
+def build_handler(app, handler, skip=()):
+    '''
+    Wrap handler with the middleware stages registered in app['__middlewares__'],
+    a list of (name, factory) where the first one is the outermost.
+    '''
+    for name, factory in reversed(app.get('__middlewares__', ())):
+        if name in skip:
+            continue
+        handler = factory(app, handler)
+    return handler
+
+def add_route(app, fn, *, auth=None, raw=None):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('coroweb.py: @get or @post not defined in %s.' %str(fn))
+    if auth is None:
+        auth = getattr(fn, '__auth__', True)
+    if raw is None:
+        raw = getattr(fn, '__raw__', False)
+    # /manage/的管理员检查在auth中间件里，不能跳过
+    if not auth and path.startswith('/manage/'):
+        raise ValueError('coroweb.py: auth can not be skipped for admin route %s.' % path)
+    skip = []
+    if not auth:
+        skip.append('auth')
+    if raw:
+        skip.append('response')
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
-    logging.info('coroweb.py: Add route %s %s => %s(%s)' %(method, path, fn.__name__, ','.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    logging.info('coroweb.py: Add route %s %s => %s(%s) skip: %s' %(method, path, fn.__name__, ','.join(inspect.signature(fn).parameters.keys()), ','.join(skip) or '-'))
+    app.router.add_route(method, path, build_handler(app, RequestHandler(app, fn, raw), skip))
 
 def add_routes(app, module_name):
     #  返回字符串中最后一个"."的位置；如没有，则返回-1
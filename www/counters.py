@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Write-behind counters, e.g. blog views and user activity.
+
+incr() only adds to an in-memory delta. Deltas are flushed every interval seconds, and on
+shutdown, as one batched upsert per 500 keys into table counters, which init() creates if
+it does not exist:
+
+    create table counters (
+        `name` varchar(50) not null,
+        `id` bigint not null,
+        `n` bigint not null,
+        primary key (`name`, `id`)
+    )
+
+get() returns the stored count plus the deltas not written yet. Stored counts are cached for
+ttl seconds, so increments flushed by other processes show up after at most ttl. Blog rows
+are not used to store counts because Model.update() writes back every column and would
+overwrite them.
+'''
+
+import asyncio, logging
+
+import orm
+from cache import LRUCache
+
+TABLE = 'counters'
+DDL = 'create table if not exists `%s` (`name` varchar(50) not null, `id` bigint not null, `n` bigint not null, primary key (`name`, `id`))' % TABLE
+BATCH = 500
+
+class Counters(object):
+
+    def __init__(self, table=TABLE, cache_size=10000, ttl=60):
+        self.table = table
+        self._pending = dict()      # (name, id) -> delta not written yet
+        self._flushing = dict()     # (name, id) -> delta being written
+        self._stored = LRUCache(cache_size, ttl=ttl)   # (name, id) -> count in the table
+        self._lock = asyncio.Lock()
+        # flush开始和结束时各加一，用来判断select期间有没有flush
+        self._generation = 0
+
+    def incr(self, name, id, n=1):
+        key = (name, id)
+        self._pending[key] = self._pending.get(key, 0) + n
+
+    def pending(self):
+        return len(self._pending)
+
+    def _unwritten(self, key):
+        return self._pending.get(key, 0) + self._flushing.get(key, 0)
+
+    async def get(self, name, id):
+        '''
+        Count of (name, id) including deltas not flushed yet.
+        '''
+        key = (name, id)
+        stored = self._stored.get(key)
+        if stored is None:
+            busy = self._lock.locked()
+            generation = self._generation
+            stored = await self._load(name, id)
+            if busy or generation != self._generation:
+                # select和flush重叠时读到的可能是写入前或写入后的值，和_flushing对不上；
+                # 等flush结束后在锁里重新读
+                async with self._lock:
+                    stored = await self._load(name, id)
+                    self._stored.set(key, stored)
+                    return stored + self._unwritten(key)
+            self._stored.set(key, stored)
+        return stored + self._unwritten(key)
+
+    async def _load(self, name, id):
+        rs = await orm.select('select `n` from `%s` where `name`=? and `id`=?' % self.table, [name, id], 1)
+        return rs[0]['n'] if rs else 0
+
+    def _upsert(self, n):
+        sql = 'insert into `%s` (`name`, `id`, `n`) values %s' % (self.table, ', '.join(['(?, ?, ?)'] * n))
+        if orm.dialect() == 'sqlite':
+            return sql + ' on conflict (`name`, `id`) do update set `n` = `n` + excluded.`n`'
+        return sql + ' on duplicate key update `n` = `n` + values(`n`)'
+
+    async def flush(self):
+        '''
+        Write all pending deltas, return the number of keys written.
+        '''
+        async with self._lock:
+            if not self._pending:
+                return 0
+            self._flushing, self._pending = self._pending, dict()
+            self._generation += 1
+            items = list(self._flushing.items())
+            written = 0
+            try:
+                for i in range(0, len(items), BATCH):
+                    batch = items[i:i+BATCH]
+                    args = []
+                    for (name, id), n in batch:
+                        args.extend([name, id, n])
+                    await orm.execute(self._upsert(len(batch)), args)
+                    for key, n in batch:
+                        # 下次get()重新读表，同时拿到其他进程写入的增量
+                        self._stored.pop(key)
+                        del self._flushing[key]
+                    written += len(batch)
+            finally:
+                # 没写成功的增量放回去，下次再写
+                for key, n in self._flushing.items():
+                    self._pending[key] = self._pending.get(key, 0) + n
+                self._flushing = dict()
+                self._generation += 1
+            logging.info('counters.py: flushed %s keys' % written)
+            return written
+
+
+_counters = Counters()
+
+def incr(name, id, n=1):
+    _counters.incr(name, id, n)
+
+async def get(name, id):
+    return await _counters.get(name, id)
+
+async def flush():
+    return await _counters.flush()
+
+async def _autoflush(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _counters.flush()
+        except Exception as e:
+            logging.exception(e)
+
+async def init(app, interval=10, cache_size=10000, ttl=60):
+    global _counters
+    await orm.execute(DDL, [])
+    _counters = Counters(cache_size=cache_size, ttl=ttl)
+    task = asyncio.ensure_future(_autoflush(interval))
+
+    async def on_shutdown(app):
+        task.cancel()
+        await _counters.flush()
+    app.on_shutdown.append(on_shutdown)
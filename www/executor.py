@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Run CPU heavy steps off the event loop.
+
+run(fn, *args, size=n) calls fn inline when the payload size n is below the threshold, and
+in the configured pool otherwise. Only module level functions with picklable arguments can
+go to a process pool; callers pass picklable=False for anything else (templates, rows),
+which then always runs in the thread pool. stats() reports queue depth and time spent.
+'''
+
+import asyncio, logging, multiprocessing, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+_kind = 'process'
+_threads = 4
+_processes = 2
+_threshold = 32 * 1024
+_pools = dict()
+_pending = 0
+_stats = dict(inline=0, inline_time=0.0, offloaded=0, max_pending=0, wait_time=0.0, run_time=0.0)
+
+def estimate_size(obj, depth=3):
+    '''
+    Rough payload size in bytes, long lists are estimated from their first items.
+    '''
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if depth <= 0:
+        return 64
+    if isinstance(obj, dict):
+        return sum(estimate_size(v, depth - 1) for v in obj.values()) + 16 * len(obj)
+    if isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n == 0:
+            return 0
+        sample = obj[:10]
+        return sum(estimate_size(v, depth - 1) for v in sample) * n // len(sample)
+    if hasattr(obj, '_asdict'):
+        return estimate_size(obj._asdict(), depth - 1)
+    if hasattr(obj, '__dict__'):
+        return estimate_size(obj.__dict__, depth - 1)
+    return 16
+
+def _get_pool(kind):
+    pool = _pools.get(kind)
+    if pool is None:
+        if kind == 'process':
+            # 这时已经有监控线程和线程池，fork出来的子进程可能继承到被占用的锁(如logging的锁)而死锁，
+            # 所以子进程从forkserver启动
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            pool = ProcessPoolExecutor(max_workers=_processes, mp_context=multiprocessing.get_context(method))
+        else:
+            pool = ThreadPoolExecutor(max_workers=_threads)
+        _pools[kind] = pool
+        logging.info('executor.py: started %s pool' % kind)
+    return pool
+
+# 在线程或子进程里执行，同时记录开始时间和耗时
+def _call(fn, args):
+    started = time.time()
+    start = time.perf_counter()
+    r = fn(*args)
+    return started, time.perf_counter() - start, r
+
+async def run(fn, *args, size=0, picklable=True):
+    '''
+    Call fn(*args), in a pool if size reaches the threshold. picklable=False: fn or args can
+    not be sent to another process, use the thread pool whatever the configured kind.
+    '''
+    global _pending
+    if size < _threshold:
+        start = time.perf_counter()
+        r = fn(*args)
+        _stats['inline'] += 1
+        _stats['inline_time'] += time.perf_counter() - start
+        return r
+    pool = _get_pool(_kind if picklable else 'thread')
+    _stats['offloaded'] += 1
+    _pending += 1
+    _stats['max_pending'] = max(_stats['max_pending'], _pending)
+    submitted = time.time()
+    try:
+        started, elapsed, r = await asyncio.get_event_loop().run_in_executor(pool, _call, fn, args)
+    finally:
+        _pending -= 1
+    _stats['wait_time'] += max(0.0, started - submitted)
+    _stats['run_time'] += elapsed
+    return r
+
+def stats():
+    s = dict(_stats)
+    s.update(kind=_kind, threshold=_threshold, pending=_pending, pools=sorted(_pools))
+    return s
+
+def init(app, kind='process', threads=4, processes=2, threshold=32*1024):
+    '''
+    kind: pool for picklable work, 'thread' or 'process'
+    threshold: payload size from which work is moved off the loop
+    '''
+    global _kind, _threads, _processes, _threshold
+    if kind not in ('thread', 'process'):
+        raise ValueError('executor.py: kind must be thread or process: %s' % kind)
+    _kind = kind
+    _threads = threads
+    _processes = processes
+    _threshold = threshold
+
+    async def on_shutdown(app):
+        for pool in _pools.values():
+            pool.shutdown(wait=False)
+        _pools.clear()
+    app.on_shutdown.append(on_shutdown)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+RSS and Atom feeds of the latest blogs, kept serialized in memory.
+
+Each entry is serialized once when its blog is created or edited; a poll only returns the
+prepared bytes, or 304 when the reader's ETag / Last-Modified is still current. Blogs created
+or edited by other processes are picked up by a reload every interval seconds.
+'''
+
+import asyncio, hashlib, logging, time
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+from models import Blog
+
+def _rfc3339(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+class Feed(object):
+    '''
+    The latest size blogs, newest first, with their pre-serialized rss item and atom entry.
+    '''
+    def __init__(self, title, link, description='', size=20):
+        self.title = title
+        self.link = link.rstrip('/')
+        self.description = description
+        self.size = size
+        self._entries = []   # [blog_id, created_at, updated_at, rss item, atom entry], newest id first
+        self._docs = dict()  # 'rss'/'atom' -> (body, etag, last_modified)
+        self._assemble()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, blog, updated_at):
+        url = escape('%s/blog/%s' % (self.link, blog.id), {'"': '&quot;'})
+        name = escape(blog.name or '')
+        summary = escape(blog.summary or '')
+        author = escape(blog.user_name or '')
+        item = ''.join(['<item><title>', name, '</title><link>', url, '</link><guid isPermaLink="true">', url,
+                        '</guid><pubDate>', formatdate(blog.created_at, usegmt=True), '</pubDate><author>', author,
+                        '</author><description>', summary, '</description></item>'])
+        entry = ''.join(['<entry><title>', name, '</title><link href="', url, '"/><id>', url,
+                         '</id><published>', _rfc3339(blog.created_at), '</published><updated>', _rfc3339(updated_at),
+                         '</updated><author><name>', author, '</name></author><summary>', summary, '</summary></entry>'])
+        return [blog.id, blog.created_at, updated_at, item, entry]
+
+    def _assemble(self):
+        # 只把已经序列化好的条目拼接起来，不重新生成每一条
+        updated = max([e[2] for e in self._entries] or [time.time()])
+        title = escape(self.title)
+        link = escape(self.link, {'"': '&quot;'})
+        rss = ''.join(['<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel><title>', title,
+                       '</title><link>', link, '/</link><description>', escape(self.description),
+                       '</description><lastBuildDate>', formatdate(updated, usegmt=True), '</lastBuildDate>']
+                      + [e[3] for e in self._entries] + ['</channel></rss>'])
+        atom = ''.join(['<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom"><title>', title,
+                        '</title><link href="', link, '/"/><link rel="self" href="', link, '/atom"/><id>', link,
+                        '/</id><updated>', _rfc3339(updated), '</updated>']
+                       + [e[4] for e in self._entries] + ['</feed>'])
+        for kind, doc in (('rss', rss), ('atom', atom)):
+            body = doc.encode('utf-8')
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+            self._docs[kind] = (body, etag, int(updated))
+
+    def load(self, blogs):
+        '''
+        Replace the entries with blogs, return False if nothing changed. An entry whose text
+        changed since the last load counts as updated now.
+        '''
+        old = dict((e[0], e) for e in self._entries)
+        now = time.time()
+        entries = []
+        for blog in blogs[:self.size]:
+            e = old.get(blog.id)
+            entry = self._entry(blog, e[2] if e is not None else blog.created_at)
+            if e is not None and entry[3] != e[3]:
+                entry = self._entry(blog, now)
+            entries.append(entry)
+        if self._docs and [e[:4] for e in entries] == [e[:4] for e in self._entries]:
+            return False
+        self._entries = entries
+        self._assemble()
+        return True
+
+    def upsert(self, blog):
+        '''
+        Add a new blog or replace an edited one, return False if it is too old to be in the feed.
+        '''
+        entry = self._entry(blog, time.time())
+        entries = [e for e in self._entries if e[0] != blog.id]
+        i = 0
+        # 和reload()一样按id排序，id按创建时间递增
+        while i < len(entries) and entries[i][0] > blog.id:
+            i = i + 1
+        if i >= self.size:
+            return False
+        entries.insert(i, entry)
+        self._entries = entries[:self.size]
+        self._assemble()
+        return True
+
+    def remove(self, blog_id):
+        '''
+        Remove a blog, return True if it was in the feed.
+        '''
+        n = len(self._entries)
+        self._entries = [e for e in self._entries if e[0] != blog_id]
+        if len(self._entries) == n:
+            return False
+        self._assemble()
+        return True
+
+    def get(self, kind):
+        return self._docs[kind]
+
+
+_feed = None
+
+CONTENT_TYPES = {
+    'rss': 'application/rss+xml',
+    'atom': 'application/atom+xml'
+}
+
+async def reload():
+    blogs = await Blog.findAll(orderBy='`id` desc', limit=_feed.size, raw=True) or []
+    if _feed.load(blogs):
+        logging.info('feed.py: loaded %s entries' % len(_feed))
+
+async def _autoreload(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reload()
+        except Exception as e:
+            logging.exception(e)
+
+async def init(app, title, link, description='', size=20, interval=60):
+    '''
+    interval: seconds between reloads from the database, to see changes of other processes
+    '''
+    global _feed
+    _feed = Feed(title, link, description, size)
+    await reload()
+    task = asyncio.ensure_future(_autoreload(interval))
+
+    async def on_shutdown(app):
+        task.cancel()
+    app.on_shutdown.append(on_shutdown)
+
+def response(request, kind):
+    '''
+    Return the feed document, or 304 Not Modified for a conditional request that is up to date.
+    '''
+    body, etag, last_modified = _feed.get(kind)
+    not_modified = False
+    if request.headers.get('If-None-Match'):
+        not_modified = etag in [s.strip() for s in request.headers['If-None-Match'].split(',')]
+    elif request.if_modified_since is not None:
+        not_modified = request.if_modified_since.timestamp() >= last_modified
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(last_modified, usegmt=True),
+        'Cache-Control': 'public, max-age=60'
+    }
+    if not_modified:
+        return web.Response(status=304, headers=headers)
+    resp = web.Response(body=body, headers=headers)
+    resp.content_type = CONTENT_TYPES[kind]
+    resp.charset = 'utf-8'
+    return resp
+
+@Blog.listen
+def _on_blog_change(event, blog):
+    if _feed is None:
+        return
+    if event == 'remove':
+        # 删掉的日志留下的空位要从数据库补上
+        if _feed.remove(blog.id):
+            asyncio.ensure_future(reload())
+    else:
+        _feed.upsert(blog)
@@ -5,6 +5,8 @@ __author__ = 'WU Bijia'
 
 
 import re, time, json, logging, hashlib, base64
+import counters, executor, feed, orm, profiler, rendering, search
+from cache import LRUCache
 from coroweb import get, post
 from aiohttp import web
 from config import configs
@@ -13,6 +15,8 @@ from apis import APIValueError, APIResourceNotFoundError, APIPermissionError, Pa
 
 
 COOKIE_NAME = 'awesession'
+# warmup.py发出的模拟请求带这个header，不计入阅读数等统计
+WARMUP_HEADER = 'X-Warmup'
 _COOKIE_KEY = configs.session.secret
 
 def check_admin(request):
@@ -30,14 +34,28 @@ def get_page_index(page_str):
     return p
 
 
-def user2cookie(user, max_age):
+def get_comment_cursor(cursor_str):
+    '''
+    Parse keyset cursor, the id of the last comment seen.
+    '''
+    try:
+        return int(cursor_str)
+    except ValueError:
+        raise APIValueError('before', 'Invalid cursor')
+
+
+# 可以交给executor在进程池里执行
+def sha1_hex(s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+async def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
     '''
     # build cookie string by: id-expires-sha1
     expires = str(int(time.time() + max_age))
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [str(user.id), expires, await executor.run(sha1_hex, s, size=len(s))]
     return '-'.join(L)
 
 async def cookie2user(cookie_str):
@@ -57,7 +75,7 @@ async def cookie2user(cookie_str):
         if user is None:
             return None
         s = '%s-%s-%s-%s' %(uid, user.passwd, expires, _COOKIE_KEY)
-        if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
+        if sha1 != await executor.run(sha1_hex, s, size=len(s)):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
@@ -69,32 +87,90 @@ async def cookie2user(cookie_str):
 ###############################################################################
 
 @get('/')
-def index(request):
-    summary = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
-    blogs = [
-        Blog(id='1', name='Test Blog', summary=summary, created_at=time.time()-120),
-        Blog(id='2', name='Something New', summary=summary, created_at=time.time()-3600),
-        Blog(id='3', name='Learn Swift', summary=summary, created_at=time.time()-7200)
-    ]
+async def index(request):
+    blogs = await recent_blogs()
     return {
         '__template__': 'blogs.html',
         'blogs': blogs
     }
 
-@get('/register')
+# 渲染好的日志正文+第一页评论，按blog id缓存，有新评论或日志被修改时失效
+# 其他进程收到的评论和修改通知不到这里，所以只缓存page_ttl秒
+_blog_cache = LRUCache(500, ttl=configs.blogs.page_ttl)
+# 每次失效时加一，防止正在渲染的旧内容在失效之后被写回缓存
+_blog_cache_versions = dict()
+
+def invalidate_blog(blog_id):
+    key = int(blog_id)
+    _blog_cache.pop(key)
+    _blog_cache_versions[key] = _blog_cache_versions.get(key, 0) + 1
+
+# 日志总数和最新一页日志，首页和/api/blogs第一页都用它，日志有增删改时失效
+# 其他进程的修改收不到通知，所以只缓存list_ttl秒
+_blog_list_cache = LRUCache(2, ttl=configs.blogs.list_ttl)
+RECENT_BLOGS = Page(0).page_size
+
+async def blog_count():
+    num = _blog_list_cache.get('count')
+    if num is None:
+        num = await Blog.findNumber('count(id)')
+        _blog_list_cache.set('count', num)
+    return num
+
+async def recent_blogs():
+    blogs = _blog_list_cache.get('recent')
+    if blogs is None:
+        blogs = await Blog.findAll(orderBy='`id` desc', limit=RECENT_BLOGS, raw=True) or []
+        _blog_list_cache.set('recent', blogs)
+    return blogs
+
+@Blog.listen
+def _on_blog_change(event, blog):
+    invalidate_blog(blog.id)
+    _blog_list_cache.clear()
+
+@Comment.listen
+def _on_comment_change(event, comment):
+    invalidate_blog(comment.blog_id)
+
+COMMENT_PAGE_SIZE = 20
+
+async def load_comments(blog_id, before=None, size=COMMENT_PAGE_SIZE):
+    '''
+    Load one page of comments of a blog, newest first, with a single query.
+    Return (comments, cursor of the next page or None).
+    '''
+    where = '`blog_id`=?'
+    args = [blog_id]
+    if before:
+        # id按时间递增，只用主键做游标，不需要(created_at, id)索引
+        where += ' and `id`<?'
+        args.append(get_comment_cursor(before))
+    # 多取一条用来判断是否还有下一页
+    comments = await Comment.findAll(where, args, orderBy='`id` desc', limit=size+1, raw=True) or []
+    cursor = None
+    if len(comments) > size:
+        comments = comments[:size]
+        last = comments[-1]
+        cursor = str(last.id)
+    return comments, cursor
+
+###############################################################################
+
+@get('/register', auth=False)
 def register():
     return {
         '__template__': 'register.html'
     }
 
-@get('/signin')
+@get('/signin', auth=False)
 def signin():
     return {
         '__template__': 'signin.html'
     }
 
 
-@get('/signout')
+@get('/signout', auth=False, raw=True)
 def signout(request):
     referer = request.headers.get('Referer')
     r = web.HTTPFound(referer or '/')
@@ -102,6 +178,59 @@ def signout(request):
     logging.info('user signed out')
     return r
 
+@get('/blog/{id}')
+async def get_blog(request, *, id):
+    try:
+        blog_id = int(id)
+    except ValueError:
+        return web.HTTPNotFound()
+    # 按解析后的id缓存，'/blog/0123'和'/blog/123'是同一篇日志
+    page = _blog_cache.get(blog_id)
+    if page is None:
+        version = _blog_cache_versions.get(blog_id, 0)
+        blog = await Blog.find(blog_id)
+        if blog is None:
+            return web.HTTPNotFound()
+        comments, cursor = await load_comments(blog.id)
+        blog.html_content = await rendering.render(blog.content)
+        args = dict(blog=blog, comments=comments, next_cursor=cursor)
+        template = request.app['__templating__'].get_template('blog_fragment.html')
+        fragment = await executor.run(template.render, args, size=executor.estimate_size(args), picklable=False)
+        page = dict(blog_name=blog.name, blog_user_name=blog.user_name, blog_user_image=blog.user_image, fragment=fragment)
+        if _blog_cache_versions.get(blog_id, 0) == version:
+            _blog_cache.set(blog_id, page)
+    if not request.headers.get(WARMUP_HEADER):
+        counters.incr('blog_views', blog_id)
+    r = dict(page)
+    r['__template__'] = 'blog.html'
+    r['blog_id'] = blog_id
+    # 阅读数读不出来不影响显示日志
+    try:
+        r['views'] = await counters.get('blog_views', blog_id)
+    except Exception as e:
+        logging.exception(e)
+        r['views'] = None
+    return r
+
+# 负载均衡的探测：进程活着就是healthy；预热完成、没有在停机时才是ready
+@get('/healthz', auth=False, raw=True)
+def healthz():
+    return web.Response(text='ok')
+
+@get('/readyz', auth=False, raw=True)
+def readyz(request):
+    if not request.app.get('__ready__'):
+        return web.Response(status=503, text='warming up')
+    return web.Response(text='ok')
+
+@get('/feed', auth=False, raw=True)
+def get_rss(request):
+    return feed.response(request, 'rss')
+
+@get('/atom', auth=False, raw=True)
+def get_atom(request):
+    return feed.response(request, 'atom')
+
 @get('/manage/blogs/create')
 def manage_create_blog():
     return {
@@ -116,9 +245,33 @@ def manage_blogs(*, page='1'):
         '__template__': 'manage_blogs.html',
         'page_index': get_page_index(page)
     }
+@get('/manage/debug/profiles')
+def manage_debug_profiles(request):
+    check_admin(request)
+    return dict(profiles=profiler.profiles())
+
+@get('/manage/debug/profiles/{name}', raw=True)
+def manage_debug_profile(request, *, name):
+    check_admin(request)
+    text = profiler.read_profile(name)
+    if text is None:
+        return web.HTTPNotFound()
+    resp = web.Response(body=text.encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
+
+@get('/manage/debug/executor')
+def manage_debug_executor(request):
+    check_admin(request)
+    return dict(executor=executor.stats())
+
+@get('/manage/debug/loop')
+def manage_debug_loop(request):
+    check_admin(request)
+    return dict(loop=profiler.loop_stats())
 ######################################################################################
 
-@post('/api/authenticate')
+@post('/api/authenticate', auth=False, raw=True)
 async def authenticate(*, email, passwd):
     if not email:
         raise APIValueError('email', 'Invalid email')
@@ -128,14 +281,12 @@ async def authenticate(*, email, passwd):
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist')
     user = users[0]
-    sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
-    sha1.update(b':')
-    sha1.update(passwd.encode('utf-8'))
-    if user.passwd != sha1.hexdigest():
+    s = '%s:%s' % (user.salt or str(user.id), passwd)
+    if user.passwd != await executor.run(sha1_hex, s, size=len(s)):
         raise APIValueError('passwd', 'Invalid password')
+    counters.incr('user_signins', user.id)
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+    r.set_cookie(COOKIE_NAME, await user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
@@ -145,7 +296,7 @@ async def authenticate(*, email, passwd):
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
-@post('/api/users')
+@post('/api/users', auth=False, raw=True)
 async def api_register_user(*, email, name, passwd):
     if not name or not name.strip():
         raise APIValueError('name')
@@ -158,19 +309,19 @@ async def api_register_user(*, email, name, passwd):
         raise APIValueError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' %(uid, passwd)
-    user = User(id = uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
+    user = User(id = uid, salt=str(uid), name=name.strip(), email=email, passwd=await executor.run(sha1_hex, sha1_passwd, size=len(sha1_passwd)),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
     await user.save()
     # make session cookie (储存在用户本地终端上的数据)
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+    r.set_cookie(COOKIE_NAME, await user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
     return r
 
 
-@get('/api/blogs/{id}')
+@get('/api/blogs/{id}', auth=False)
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
@@ -191,12 +342,62 @@ async def api_create_blog(request, *, name, summary, content):
     await blog.save()
     return blog
 
-@get('/api/blogs')
+@get('/api/blogs/{id}/comments', auth=False)
+async def api_blog_comments(*, id, before=None):
+    comments, cursor = await load_comments(id, before)
+    return dict(comments=comments, next=cursor)
+
+
+@post('/api/blogs/{id}/comments')
+async def api_create_comment(id, request, *, content):
+    user = request.__user__
+    if user is None:
+        raise APIPermissionError('Please signin first.')
+    if not content or not content.strip():
+        raise APIValueError('content')
+    blog = await Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
+    await comment.save()
+    counters.incr('user_comments', user.id)
+    return comment
+
+@get('/api/blogs', auth=False)
 async def api_blogs(*, page='1'):
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await blog_count()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    if p.offset == 0 and p.page_size == RECENT_BLOGS:
+        blogs = await recent_blogs()
+    else:
+        blogs = await Blog.findAll(orderBy='`id` desc', limit=(p.offset, p.limit), raw=True)
     return dict(page=p, blogs=blogs)
+
+
+@get('/api/search', auth=False)
+async def api_search(*, q='', page='1'):
+    if not q or not q.strip():
+        raise APIValueError('q', 'query cannot be empty')
+    page_index = get_page_index(page)
+    index = search.get_index()
+    scores = index.score(q)
+    p = Page(len(scores), page_index)
+    if p.limit == 0:
+        return dict(page=p, blogs=())
+    hits = index.top(scores, p.offset, p.limit)
+    ids = [blog_id for blog_id, score in hits]
+    blogs = await Blog.findAll('`id` in (%s)' % orm.create_args_string(len(ids)), ids) or []
+    found = dict((blog.id, blog) for blog in blogs)
+    results = []
+    for blog_id, score in hits:
+        blog = found.get(blog_id)
+        if blog is None:
+            continue
+        # 搜索结果只需要摘要
+        blog.pop('content', None)
+        blog.score = score
+        results.append(blog)
+    return dict(page=p, blogs=results)
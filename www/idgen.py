@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Time ordered 64-bit primary keys.
+
+An id is (milliseconds since EPOCH << 12) | (worker << 7) | sequence. Ids generated later
+are larger, so "order by id" is "order by creation time" and recent rows are at the end
+of the primary key index. The layout uses 53 bits so ids survive JSON numbers in the
+browser; the column is still a bigint.
+
+Every process needs its own worker id: it is either configured, or claimed at startup by
+locking one of the lock files webapp-id-worker-N.lock in lock_dir.
+'''
+
+import logging, os, tempfile, threading, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+EPOCH = 1262304000000   # 2010-01-01 00:00:00 UTC, ms
+TIMESTAMP_BITS = 41
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+def make_id(ms, worker, sequence):
+    return ((ms - EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence
+
+def parse_id(id):
+    '''
+    Return (ms, worker, sequence) of an id.
+    '''
+    id = int(id)
+    return (id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH, (id >> SEQUENCE_BITS) & MAX_WORKER, id & MAX_SEQUENCE
+
+
+class IdGenerator(object):
+    '''
+    Monotonic id generator of one worker, thread safe.
+    '''
+    def __init__(self, worker):
+        if worker < 0 or worker > MAX_WORKER:
+            raise ValueError('idgen.py: worker must be in 0..%s: %s' % (MAX_WORKER, worker))
+        self.worker = worker
+        self._last = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self, ms=None):
+        '''
+        Next id, ms defaults to the current time.
+        '''
+        if ms is None:
+            ms = int(time.time() * 1000)
+        with self._lock:
+            # 时钟回拨或同一毫秒内序号用完时，借用上一次的时间继续往后排，保证单调递增
+            if ms <= self._last:
+                ms = self._last
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last = ms
+            return make_id(ms, self.worker, self._sequence)
+
+
+_lock_files = []
+
+def claim_worker(lock_dir=None):
+    '''
+    Claim a worker id not used by any other process on this host, held until the process exits.
+    '''
+    if fcntl is None:
+        worker = os.getpid() & MAX_WORKER
+        logging.warning('idgen.py: file locks not supported, use worker id %s from pid' % worker)
+        return worker
+    lock_dir = lock_dir or tempfile.gettempdir()
+    for worker in range(MAX_WORKER + 1):
+        f = open(os.path.join(lock_dir, 'webapp-id-worker-%d.lock' % worker), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            continue
+        _lock_files.append(f)
+        return worker
+    raise RuntimeError('idgen.py: all %s worker ids in %s are in use' % (MAX_WORKER + 1, lock_dir))
+
+
+_generator = None
+
+def set_generator(generator):
+    '''
+    Replace the id generator, any object with a next_id() method.
+    '''
+    global _generator
+    _generator = generator
+
+def init(worker=None, lock_dir=None):
+    if worker is None:
+        worker = claim_worker(lock_dir)
+    logging.info('idgen.py: worker id: %s' % worker)
+    set_generator(IdGenerator(worker))
+
+def next_id():
+    if _generator is None:
+        init()
+    return _generator.next_id()
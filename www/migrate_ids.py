@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Migrate users, blogs and comment from the old 50-char string ids to bigint ids (see idgen.py).
+
+The timestamp of a new id is taken from the old id, which starts with the creation time in
+milliseconds, so ids keep their order. blogs.user_id, comment.blog_id and comment.user_id
+are rewritten to the new ids. The old user id is kept in users.salt because it salts the
+stored password hash. Old session cookies stop working.
+
+Stop the app and back up the database first:
+
+    python3 migrate_ids.py [--dry-run]
+'''
+
+import asyncio, logging, sys
+
+import idgen, orm
+from config import configs
+
+# 表名 -> 引用其他表id的列
+TABLES = [
+    ('users', []),
+    ('blogs', [('user_id', 'users')]),
+    ('comment', [('blog_id', 'blogs'), ('user_id', 'users')])
+]
+
+BATCH = 500
+
+class Migration(object):
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+
+    async def execute(self, sql, args=()):
+        if self.dry_run:
+            logging.info('migrate_ids.py: [dry-run] %s' % sql)
+            return 0
+        return await orm.execute(sql, args)
+
+    async def check(self):
+        # MySQL 8返回的列名是大写的DATA_TYPE，用别名固定下来
+        rs = await orm.select("select `data_type` as `data_type` from information_schema.columns where `table_schema`=database() and `table_name`='users' and `column_name`='id'", [])
+        if not rs:
+            raise RuntimeError('migrate_ids.py: table users not found')
+        if rs[0]['data_type'] == 'bigint':
+            raise RuntimeError('migrate_ids.py: ids are already bigint, nothing to do')
+
+    async def assign_ids(self, table):
+        '''
+        Fill column new_id, in the order of the old ids.
+        '''
+        await self.execute('alter table `%s` add column `new_id` bigint' % table)
+        rs = await orm.select('select `id` from `%s` order by `id`' % table, [])
+        # 每张表各用一个生成器，旧id里的时间是递增的，新id也就保持同样的顺序
+        gen = idgen.IdGenerator(0)
+        pairs = [(r['id'], gen.next_id(int(r['id'][:15]))) for r in rs]
+        for i in range(0, len(pairs), BATCH):
+            batch = pairs[i:i+BATCH]
+            args = []
+            for old, new in batch:
+                args.extend([old, new])
+            args.extend([old for old, new in batch])
+            await self.execute('update `%s` set `new_id` = case `id` %s end where `id` in (%s)' % (
+                table, ' '.join(['when ? then ?'] * len(batch)), orm.create_args_string(len(batch))), args)
+        logging.info('migrate_ids.py: %s: %s ids assigned' % (table, len(pairs)))
+
+    async def rewrite_refs(self, table, refs):
+        for column, ref_table in refs:
+            await self.execute('alter table `%s` add column `new_%s` bigint' % (table, column))
+            await self.execute('update `%s` t join `%s` r on t.`%s` = r.`id` set t.`new_%s` = r.`new_id`' % (table, ref_table, column, column))
+            # 指向已删除记录的引用没有对应的新id
+            n = await self.execute('update `%s` set `new_%s` = 0 where `new_%s` is null' % (table, column, column))
+            if n:
+                logging.warning('migrate_ids.py: %s.%s: %s rows reference missing %s, set to 0' % (table, column, n, ref_table))
+
+    async def swap_columns(self, table, refs):
+        changes = ['drop primary key', 'drop column `id`']
+        changes.extend(['drop column `%s`' % column for column, ref_table in refs])
+        changes.append('change column `new_id` `id` bigint not null')
+        changes.extend(['change column `new_%s` `%s` bigint not null' % (column, column) for column, ref_table in refs])
+        changes.append('add primary key (`id`)')
+        await self.execute('alter table `%s` %s' % (table, ', '.join(changes)))
+
+    async def run(self):
+        await self.check()
+        await self.execute('alter table `users` add column `salt` varchar(50)')
+        await self.execute('update `users` set `salt` = `id`')
+        for table, refs in TABLES:
+            await self.assign_ids(table)
+        for table, refs in TABLES:
+            await self.rewrite_refs(table, refs)
+        # 所有引用都改写完之后才能删除旧的id
+        for table, refs in TABLES:
+            await self.swap_columns(table, refs)
+        logging.info('migrate_ids.py: done')
+
+
+async def main(loop, dry_run):
+    db = configs.db
+    await orm.create_pool(loop=loop, host=db.host, port=db.port, user=db.user, password=db.password, db=db.db)
+    await Migration(dry_run).run()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, '--dry-run' in sys.argv[1:]))
@@ -1,12 +1,13 @@
 
 
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+import idgen
+from orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField
 
-# 生成id
+# 生成id，按时间递增的bigint，见idgen.py
 def next_id():
-    return '%015d%s000' % (int(time.time()*1000), uuid.uuid4().hex)
+    return idgen.next_id()
 
 # ORM
 # 创建实例： user = User(id = 123, name = 'Jack')
@@ -19,9 +20,11 @@ class User(Model):
     # 由于可以传入关键字参数，所以不冲突
     __table__ = 'users'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    id = IntegerField(primary_key=True, default=next_id)
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
+    # 口令hash用的salt，新用户就是id；从旧的字符串id迁移过来的用户是旧id
+    salt = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
@@ -32,8 +35,8 @@ class User(Model):
 class Blog(Model):
     __table__ = 'blogs'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IntegerField(primary_key=True, default=next_id)
+    user_id = IntegerField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
@@ -44,12 +47,17 @@ class Blog(Model):
 class Comment(Model):
     __table__ = 'comment'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IntegerField(primary_key=True, default=next_id)
+    blog_id = IntegerField()
+    user_id = IntegerField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(default=time.time)
 
+# 渲染好的日志HTML，按内容的sha1存放，可选
+class RenderedContent(Model):
+    __table__ = 'rendered_content'
 
+    id = StringField(primary_key=True, ddl='char(40)')
+    html = TextField()
@@ -2,13 +2,26 @@
 
 import aiomysql
 
-import logging
+import inspect, logging
 logging.basicConfig(level = logging.INFO)
 
 def log(sql):
     logging.info("orm.py: SQL: %s" %sql)
 
 __pool = None
+# 可替换的数据库后端，例如sqlite_backend.SQLiteBackend；为None时使用aiomysql连接池
+__backend = None
+
+def use_backend(backend):
+    '''
+    Send all SQL to backend instead of the MySQL pool. backend must provide
+    coroutines select(sql, args, size, as_dict) and execute(sql, args) taking '?' placeholders.
+    '''
+    global __backend
+    __backend = backend
+
+def dialect():
+    return getattr(__backend, 'dialect', 'mysql') if __backend is not None else 'mysql'
 
 # 创建全局连接池，每个http请求都可以从连接池中直接获取数据库链接
 # 不必频繁的打开和关闭数据库链接
@@ -28,14 +41,36 @@ async def create_pool(loop, **kw):
         loop = loop
     )
 
+# 预先打开连接，避免刚启动时每个请求都要等新建连接
+async def warm_pool(size):
+    'open connections until the pool holds size of them, return the number opened'
+    global __pool
+    if __backend is not None or __pool is None:
+        return 0
+    conns = []
+    try:
+        for n in range(min(size, __pool.maxsize)):
+            conns.append(await __pool.acquire())
+        for conn in conns:
+            cur = await conn.cursor()
+            await cur.execute('select 1')
+            await cur.close()
+    finally:
+        for conn in conns:
+            __pool.release(conn)
+    return len(conns)
+
 # SELECT
 # size: number of rows to return
-async def select(sql, args, size = None):
+# as_dict: False返回tuple，省掉每行构造dict
+async def select(sql, args, size = None, as_dict = True):
     log(sql)
     global __pool
+    if __backend is not None:
+        return await __backend.select(sql, args, size, as_dict)
     with (await __pool) as conn:
         # A cursor which returns results as a dict
-        cur = await conn.cursor(aiomysql.DictCursor)
+        cur = await conn.cursor(aiomysql.DictCursor if as_dict else aiomysql.Cursor)
         # yield from cursor.execute('SELECT * FROM t1 WHERE id=?', (5,))
         await cur.execute(sql.replace('?', '%s'), args or ())
         if size:
@@ -50,6 +85,8 @@ async def select(sql, args, size = None):
 async def execute(sql, args):
     log(sql)
     global __pool
+    if __backend is not None:
+        return await __backend.execute(sql, args)
     with (await __pool) as conn:
         try:
             cur = await conn.cursor()
@@ -104,6 +141,50 @@ class TextField(Field):
         super().__init__(name, ddl, False, default)
 
 
+# 只读的行对象，用__slots__代替dict，每个Model生成一个，见Model.findAll(raw=True)
+class Row(object):
+    __slots__ = ()
+    __columns__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    # 只能取列，不能取到get、_asdict等方法
+    def __getitem__(self, key):
+        if key not in self.__columns__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.__columns__:
+            return default
+        return getattr(self, key)
+
+    def _asdict(self):
+        return dict((k, getattr(self, k)) for k in self.__columns__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, getattr(self, k)) for k in self.__columns__))
+
+def create_row_class(name, columns):
+    '''
+    Row subclass with one slot per column and a _make(values) constructor taking values in
+    the order of columns.
+    '''
+    row = type('%sRow' % name, (Row,), dict(__slots__=tuple(columns), __columns__=tuple(columns)))
+    # 和namedtuple一样生成一个没有循环的构造函数，直接用slot描述符赋值，比逐个setattr快
+    ns = dict(new=object.__new__, cls=row)
+    values = []
+    body = []
+    for n, k in enumerate(columns):
+        ns['set%d' % n] = getattr(row, k).__set__
+        values.append('v%d' % n)
+        body.append('    set%d(row, v%d)' % (n, n))
+    src = 'def _make(values):\n    %s, = values\n    row = new(cls)\n%s\n    return row\n' % (', '.join(values), '\n'.join(body))
+    exec(src, ns)
+    row._make = staticmethod(ns['_make'])
+    return row
+
 # 把class看成是metaclass创建出来的实例
 # metaclass是类的模版，所以必须从'type'类型派生，'type'是所有类的元类
 class ModelMetaclass(type):
@@ -143,9 +224,13 @@ class ModelMetaclass(type):
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields # 除主键外的属性名
         attrs['__select__'] = 'select %s, %s from %s' %(primaryKey, ', '.join(escaped_field), tableName)
-        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) value (%s)' %(tableName, ', '.join(escaped_field), primaryKey, create_args_string(len(escaped_field)+1))
+        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' %(tableName, ', '.join(escaped_field), primaryKey, create_args_string(len(escaped_field)+1))
         attrs['__update__'] = 'update `%s` set %s where `%s` =?' % (tableName, ', '.join(map(lambda f:'`%s`=?' %(mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' %(tableName, primaryKey)
+        # save/update/remove之后要通知的监听者，每个Model各自一份
+        attrs['__listeners__'] = []
+        # 列的顺序和__select__一致
+        attrs['__row__'] = create_row_class(name, [primaryKey] + fields)
         # 这里返回的对象attrs已被更新
         return type.__new__(cls, name, bases, attrs)
 
@@ -190,19 +275,47 @@ class Model(dict, metaclass = ModelMetaclass):
     # TODO: can add more kw key
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
-        'find all object'
-        sql = '%s' %cls.__select__
+        '''
+        find all object
+        raw=True: return read-only row objects (cls.__row__) instead of Model instances
+        raw='tuple': return tuples in the order of cls.__row__.__columns__
+        raw='columns': return dict of column name -> list of values
+        '''
+        sql = [cls.__select__]
         if where:
-            sql += ' where %s' %where
+            sql.append('where')
+            sql.append(where)
         if args is None:
             args = []
-        orderBy = kw.get(' orderBy', None)
+        else:
+            args = list(args)
+        orderBy = kw.get('orderBy', None)
         if orderBy:
-            sql += 'order by %s' %orderBy
-        rs = await select(sql, args)
+            sql.append('order by')
+            sql.append(orderBy)
+        limit = kw.get('limit', None)
+        if limit is not None:
+            if isinstance(limit, int):
+                sql.append('limit ?')
+                args.append(limit)
+            elif isinstance(limit, tuple) and len(limit) == 2:
+                sql.append('limit ?, ?')
+                args.extend(limit)
+            else:
+                raise ValueError('orm.py: Invalid limit value: %s' % str(limit))
+        sql = ' '.join(sql)
+        raw = kw.get('raw', False)
+        rs = await select(sql, args, as_dict=not raw)
         if len(rs) == 0:
             return None
-        return [cls(**r) for r in rs]
+        if not raw:
+            return [cls(**r) for r in rs]
+        if raw == 'tuple':
+            return [tuple(r) for r in rs]
+        if raw == 'columns':
+            return dict(zip(cls.__row__.__columns__, map(list, zip(*rs))))
+        make = cls.__row__._make
+        return [make(r) for r in rs]
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
@@ -211,12 +324,31 @@ class Model(dict, metaclass = ModelMetaclass):
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(''.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
 
+    @classmethod
+    def listen(cls, fn):
+        '''
+        Register fn(event, obj) to be called after save/update/remove, event is one of
+        'save', 'update', 'remove'. fn may be a coroutine function. Can be used as decorator.
+        '''
+        cls.__listeners__.append(fn)
+        return fn
+
+    async def _notify(self, event):
+        for fn in self.__listeners__:
+            # 监听者出错不影响已经写入数据库的结果
+            try:
+                r = fn(event, self)
+                if inspect.isawaitable(r):
+                    await r
+            except Exception as e:
+                logging.exception(e)
+
     async def update(self):
         'update object'
         args = list(map(self.getValue, self.__fields__))
@@ -224,6 +356,7 @@ class Model(dict, metaclass = ModelMetaclass):
         rows = await execute(self.__update__, args)
         if rows != 1:
             logging.warning('orm.py: failed to update: affected rows: %s' % rows)
+        await self._notify('update')
 
     async def remove(self):
         'remove object'
@@ -231,6 +364,7 @@ class Model(dict, metaclass = ModelMetaclass):
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warning('orm.py: failed to delete record: affected rows: %s' % rows)
+        await self._notify('remove')
 
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
@@ -238,5 +372,4 @@ class Model(dict, metaclass = ModelMetaclass):
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warning('orm.py: failed to insert record: affected rows: %s' % rows)
-
-
+        await self._notify('save')
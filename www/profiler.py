@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Opt-in request profiling and event loop lag monitoring.
+
+A request is profiled when it is picked by the sampling rate, or when it carries a valid
+X-Profile header '<expires>-<hmac-sha256(secret, expires)>'. cProfile stats and the top allocations
+seen by tracemalloc are written to the dump directory. Both profilers are process wide, so
+the dump also contains whatever other requests ran on the loop meanwhile; only one request
+is profiled at a time.
+
+The loop monitor measures how late a periodic timer fires. A watchdog thread logs the stack
+of the loop thread when the loop has not come back for longer than the threshold, which
+points at the blocking call.
+'''
+
+import asyncio, cProfile, collections, hashlib, hmac, io, logging, os, pstats, random, sys, threading, time, traceback, tracemalloc
+
+PROFILE_HEADER = 'X-Profile'
+
+_rate = 0.0
+_secret = None
+_dir = None
+_busy = False
+_profiles = collections.deque(maxlen=50)
+_writing = dict()   # name -> future of _write_dump not finished yet
+_monitor = None
+
+def sign(expires, secret):
+    '''
+    Value of the X-Profile header valid until expires.
+    '''
+    mac = hmac.new(secret.encode('utf-8'), str(int(expires)).encode('utf-8'), hashlib.sha256).hexdigest()
+    return '%s-%s' % (int(expires), mac)
+
+def _signed(request):
+    value = request.headers.get(PROFILE_HEADER)
+    if not value or not _secret:
+        return False
+    try:
+        expires, mac = value.split('-', 1)
+        if int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(value, sign(expires, _secret))
+
+def should_profile(request):
+    if _busy:
+        return False
+    if _rate > 0 and random.random() < _rate:
+        return True
+    return _signed(request)
+
+def _write_dump(name, prof, snapshot, info):
+    path = os.path.join(_dir, name)
+    prof.dump_stats(path + '.prof')
+    s = io.StringIO()
+    s.write('%s %s %s %.3f ms\n\n' % (info['method'], info['path'], info['status'], info['elapsed'] * 1000))
+    pstats.Stats(prof, stream=s).sort_stats('cumulative').print_stats(40)
+    s.write('\nTop allocations:\n')
+    for stat in snapshot.statistics('lineno')[:20]:
+        s.write('%s\n' % stat)
+    with open(path + '.txt', 'w') as f:
+        f.write(s.getvalue())
+    logging.info('profiler.py: profile written: %s' % path)
+
+def _remove_dump(name):
+    for ext in ('.prof', '.txt'):
+        try:
+            os.remove(os.path.join(_dir, name + ext))
+        except FileNotFoundError:
+            pass
+
+def _log_error(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        e = fut.exception()
+        logging.error('profiler.py: dump file operation failed', exc_info=(type(e), e, e.__traceback__))
+
+def _submit(fn, *args):
+    fut = asyncio.get_event_loop().run_in_executor(None, fn, *args)
+    fut.add_done_callback(_log_error)
+    return fut
+
+def _add_profile(name, prof, snapshot, info):
+    '''
+    Keep info in the recent profiles and write its dump, delete the files of the profile
+    that falls out of the deque.
+    '''
+    dropped = _profiles[0]['name'] if len(_profiles) == _profiles.maxlen else None
+    _profiles.append(info)
+    # 统计结果的排序和写文件放到线程池，不拖慢这个请求
+    fut = _writing[name] = _submit(_write_dump, name, prof, snapshot, info)
+    fut.add_done_callback(lambda f: _writing.pop(name, None))
+    if dropped is None:
+        return
+    pending = _writing.get(dropped)
+    if pending is None:
+        _submit(_remove_dump, dropped)
+    else:
+        # 还没写完就删，写完的文件会留下来
+        pending.add_done_callback(lambda f: _submit(_remove_dump, dropped))
+
+def profile_factory(app, handler):
+    '''
+    Middleware stage profiling the rest of the handler chain.
+    '''
+    if _rate <= 0 and not _secret:
+        return handler
+    async def profile(request):
+        global _busy
+        if not should_profile(request):
+            return (await handler(request))
+        _busy = True
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(10)
+        prof = cProfile.Profile()
+        status = 500
+        start = time.perf_counter()
+        prof.enable()
+        try:
+            r = await handler(request)
+            status = getattr(r, 'status', 200)
+            return r
+        finally:
+            prof.disable()
+            elapsed = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            _busy = False
+            name = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), os.urandom(3).hex())
+            info = dict(name=name, time=time.time(), method=request.method, path=request.path, status=status, elapsed=elapsed)
+            _add_profile(name, prof, snapshot, info)
+    return profile
+
+def profiles():
+    'recent profiles, newest first'
+    return list(reversed(_profiles))
+
+def read_profile(name):
+    '''
+    Return the text summary of a recent profile, None if there is no such profile.
+    '''
+    if name not in [p['name'] for p in _profiles]:
+        return None
+    try:
+        with open(os.path.join(_dir, name + '.txt')) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class LoopMonitor(object):
+    '''
+    Measure event loop lag and log the loop thread's stack when it is blocked.
+    '''
+    def __init__(self, loop, interval=0.1, threshold=0.5):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.blocked = collections.deque(maxlen=10)
+        self._heartbeat = time.monotonic()
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._task = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._task = asyncio.ensure_future(self._tick())
+        threading.Thread(target=self._watchdog, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _tick(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.loop.time() - start - self.interval)
+            self.count += 1
+            self.total += lag
+            self.last = lag
+            self.max = max(self.max, lag)
+            self._heartbeat = time.monotonic()
+
+    def _watchdog(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # 同一次阻塞只记录一次
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self._thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            self.blocked.append(dict(time=time.time(), blocked=blocked, stack=stack))
+            logging.warning('profiler.py: event loop blocked for %.3f s:\n%s' % (blocked, stack))
+
+    def stats(self):
+        return dict(
+            interval=self.interval,
+            threshold=self.threshold,
+            last=self.last,
+            max=self.max,
+            avg=self.total / self.count if self.count else 0.0,
+            blocked=list(self.blocked)
+        )
+
+def loop_stats():
+    return _monitor.stats() if _monitor is not None else None
+
+def init(app, loop, rate=0.0, secret=None, dir=None, keep=50, lag_interval=0.1, lag_threshold=0.5):
+    '''
+    Must be called before routes are added. lag_threshold=None disables the loop monitor.
+    '''
+    global _rate, _secret, _dir, _profiles, _monitor
+    _rate = rate
+    _secret = secret
+    _dir = dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'profiles')
+    _profiles = collections.deque(maxlen=keep)
+    if _rate > 0 or _secret:
+        os.makedirs(_dir, exist_ok=True)
+        logging.info('profiler.py: profiling enabled, rate: %s, dump dir: %s' % (_rate, _dir))
+    if lag_threshold:
+        _monitor = LoopMonitor(loop, lag_interval, lag_threshold)
+        _monitor.start()
+
+        async def on_shutdown(app):
+            _monitor.stop()
+        app.on_shutdown.append(on_shutdown)
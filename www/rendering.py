@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Markdown rendering of blog content.
+
+Every distinct content is converted once: results are kept in a size bounded LRU keyed by
+the sha1 of the content, optionally persisted to the rendered_content table, and large
+contents are converted in the executor's pool so the event loop is not blocked.
+'''
+
+import asyncio, hashlib, logging
+
+import executor
+from cache import LRUCache
+from models import Blog, RenderedContent
+
+try:
+    import markdown2
+except ImportError:
+    markdown2 = None
+    logging.warning('rendering.py: markdown2 not installed, blog content is rendered as plain text')
+
+
+def text2html(text):
+    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+# 必须是模块级函数，才能交给进程池执行
+def markdown_to_html(text):
+    if markdown2 is None:
+        return text2html(text)
+    return markdown2.markdown(text, extras=['fenced-code-blocks', 'tables'])
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+_cache = LRUCache(16 * 1024 * 1024, sizeof=len)
+_pending = dict()   # content hash -> Future, 同一内容同时只渲染一次
+_persist = False
+
+def init(cache_size=16*1024*1024, persist=False):
+    '''
+    cache_size: max total length of cached html
+    persist: also store html in the rendered_content table
+    '''
+    global _cache, _persist
+    _cache = LRUCache(cache_size, sizeof=len)
+    _persist = persist
+
+async def _render(key, text):
+    if _persist:
+        r = await RenderedContent.find(key)
+        if r is not None:
+            return r.html
+    html = await executor.run(markdown_to_html, text, size=len(text))
+    if _persist:
+        try:
+            await RenderedContent(id=key, html=html).save()
+        except Exception as e:
+            # 其他进程可能已经写入了同一个hash
+            logging.warning('rendering.py: failed to persist %s: %s' % (key, e))
+    return html
+
+async def render(text):
+    '''
+    Return html of markdown text.
+    '''
+    if not text:
+        return ''
+    key = content_hash(text)
+    html = _cache.get(key)
+    if html is not None:
+        return html
+    fut = _pending.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = _pending[key] = asyncio.ensure_future(_render(key, text))
+    try:
+        html = await asyncio.shield(fut)
+    finally:
+        _pending.pop(key, None)
+    _cache.set(key, html)
+    return html
+
+def stats():
+    return dict(cache=str(_cache), pending=len(_pending))
+
+@Blog.listen
+def _on_blog_change(event, blog):
+    # 保存/修改日志后在后台预先渲染，第一次查看时不用再等
+    if event != 'remove' and blog.get('content'):
+        asyncio.ensure_future(render(blog.content))
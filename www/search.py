@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-process full-text search over blogs.
+
+An inverted index over Blog.name, summary and content, ranked with BM25. Posting lists
+are kept as two parallel arrays (doc numbers, term frequencies) instead of python objects.
+The index is built at startup, kept current by Blog.listen() hooks and snapshotted to
+disk, so a restart only has to re-read the blogs whose text changed.
+'''
+
+import asyncio, bisect, heapq, logging, math, os, pickle, re, zlib
+from array import array
+
+import orm
+from models import Blog
+
+# ascii单词整体作为一个词；中日韩文字没有空格分词，用相邻两字(bigram)作为词，单字的段落保留单字
+# 建索引时另外把每个字(unigram)也作为词，'书'、'猫'这样的单字查询才能命中
+_RE_TOKEN = re.compile(r'[0-9a-z]+|[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+
+def tokenize(text, unigrams=False):
+    '''
+    Split text into index terms, CJK runs are split into overlapping bigrams.
+    unigrams=True: also yield every CJK character, used when indexing.
+    '''
+    if not text:
+        return
+    for m in _RE_TOKEN.finditer(text.lower()):
+        w = m.group()
+        if w[0] < '\u3040':
+            if len(w) <= 40:
+                yield w
+        elif len(w) == 1:
+            yield w
+        else:
+            for i in range(len(w) - 1):
+                yield w[i:i+2]
+            if unigrams:
+                for c in w:
+                    yield c
+
+def signature(name, summary, content):
+    '''
+    Checksum of the indexed text, must match the crc32(concat_ws(...)) computed in SQL by sync().
+    '''
+    s = '\n'.join(x for x in (name, summary, content) if x is not None)
+    return zlib.crc32(s.encode('utf-8'))
+
+
+class SearchIndex(object):
+    '''
+    BM25 inverted index, documents are identified by blog id.
+    '''
+    # 标题里出现的词比正文更重要
+    FIELDS = (('name', 3), ('summary', 2), ('content', 1))
+    K1 = 1.2
+    B = 0.75
+    VERSION = 2
+
+    def __init__(self):
+        self._ids = []               # docno -> blog id, None if removed
+        self._docnos = {}            # blog id -> docno
+        self._lengths = array('I')   # docno -> weighted document length
+        self._terms = {}             # docno -> tuple of terms, used to remove a document
+        self._sigs = {}              # blog id -> signature()
+        self._postings = {}          # term -> (array('I') docnos, array('H') tfs), docnos sorted
+        self._total_length = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._docnos)
+
+    def add(self, blog):
+        'add or replace blog'
+        tfs = {}
+        length = 0
+        for field, weight in self.FIELDS:
+            for t in tokenize(blog.get(field), unigrams=True):
+                tfs[t] = tfs.get(t, 0) + weight
+                length += weight
+        docno = self._docnos.get(blog.id)
+        if docno is None:
+            docno = len(self._ids)
+            self._ids.append(blog.id)
+            self._lengths.append(0)
+            self._docnos[blog.id] = docno
+        else:
+            self._unlink(docno)
+        for t, tf in tfs.items():
+            p = self._postings.get(t)
+            if p is None:
+                p = self._postings[t] = (array('I'), array('H'))
+            docnos, freqs = p
+            # 新文档的docno最大，直接追加；更新的文档沿用原来的docno，需要插入到有序位置
+            i = bisect.bisect_left(docnos, docno)
+            docnos.insert(i, docno)
+            freqs.insert(i, min(tf, 0xffff))
+        self._terms[docno] = tuple(tfs)
+        self._lengths[docno] = length
+        self._total_length += length
+        self._sigs[blog.id] = signature(blog.get('name'), blog.get('summary'), blog.get('content'))
+        self.dirty = True
+
+    def remove(self, blog_id):
+        'remove blog by id'
+        docno = self._docnos.pop(blog_id, None)
+        if docno is None:
+            return
+        self._unlink(docno)
+        self._ids[docno] = None
+        self._sigs.pop(blog_id, None)
+        self.dirty = True
+
+    def _unlink(self, docno):
+        for t in self._terms.pop(docno, ()):
+            docnos, freqs = self._postings[t]
+            i = bisect.bisect_left(docnos, docno)
+            if i < len(docnos) and docnos[i] == docno:
+                del docnos[i]
+                del freqs[i]
+            if not docnos:
+                del self._postings[t]
+        self._total_length -= self._lengths[docno]
+        self._lengths[docno] = 0
+
+    def score(self, query):
+        '''
+        Return dict of docno -> BM25 score for all documents matching any term of query.
+        '''
+        scores = dict()
+        n = len(self._docnos)
+        if n == 0:
+            return scores
+        avgdl = self._total_length / n or 1.0
+        lengths = self._lengths
+        k1, b = self.K1, self.B
+        for t in set(tokenize(query)):
+            p = self._postings.get(t)
+            if p is None:
+                continue
+            docnos, freqs = p
+            df = len(docnos)
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            for d, tf in zip(docnos, freqs):
+                s = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[d] / avgdl))
+                scores[d] = scores.get(d, 0.0) + s
+        return scores
+
+    def top(self, scores, offset, limit):
+        '''
+        Return [(blog_id, score)] of the given page of scores, best first.
+        '''
+        best = heapq.nlargest(offset + limit, scores.items(), key=lambda x: x[1])
+        return [(self._ids[d], s) for d, s in best[offset:]]
+
+    def signatures(self):
+        return self._sigs
+
+    def dumps(self):
+        return pickle.dumps(dict(
+            version=self.VERSION,
+            ids=self._ids,
+            lengths=self._lengths,
+            terms=self._terms,
+            sigs=self._sigs,
+            postings=self._postings,
+            total_length=self._total_length
+        ), pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, data):
+        d = pickle.loads(data)
+        if d.get('version') != cls.VERSION:
+            raise ValueError('search.py: unsupported snapshot version: %s' % d.get('version'))
+        index = cls()
+        index._ids = d['ids']
+        index._docnos = dict((blog_id, docno) for docno, blog_id in enumerate(index._ids) if blog_id is not None)
+        index._lengths = d['lengths']
+        index._terms = d['terms']
+        index._sigs = d['sigs']
+        index._postings = d['postings']
+        index._total_length = d['total_length']
+        return index
+
+
+_index = SearchIndex()
+_snapshot = None
+
+def get_index():
+    return _index
+
+def _default_snapshot():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'search.idx')
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+async def save_snapshot():
+    if _snapshot is None or not _index.dirty:
+        return
+    # pickle在事件循环里做，保证拿到的是一致的索引；写文件放到线程池
+    data = _index.dumps()
+    _index.dirty = False
+    await asyncio.get_event_loop().run_in_executor(None, _write_file, _snapshot, data)
+    logging.info('search.py: snapshot saved: %s docs, %s bytes' % (len(_index), len(data)))
+
+def load_snapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            index = SearchIndex.loads(f.read())
+        logging.info('search.py: snapshot loaded: %s docs' % len(index))
+        return index
+    except FileNotFoundError:
+        return SearchIndex()
+    except Exception as e:
+        logging.warning('search.py: ignore broken snapshot %s: %s' % (path, e))
+        return SearchIndex()
+
+async def sync(batch=200):
+    '''
+    Bring the index up to date with the blogs table. Only ids and checksums are read for
+    every row, full rows are streamed in batches for blogs that are new or changed.
+    '''
+    rs = await orm.select('select `id`, crc32(concat_ws(char(10), `name`, `summary`, `content`)) `_sig_` from `%s`' % Blog.__table__, [])
+    sigs = _index.signatures()
+    stored = set()
+    changed = []
+    for r in rs:
+        stored.add(r['id'])
+        if sigs.get(r['id']) != r['_sig_']:
+            changed.append(r['id'])
+    removed = [blog_id for blog_id in sigs if blog_id not in stored]
+    for blog_id in removed:
+        _index.remove(blog_id)
+    for i in range(0, len(changed), batch):
+        ids = changed[i:i+batch]
+        blogs = await Blog.findAll('`id` in (%s)' % orm.create_args_string(len(ids)), ids, raw=True)
+        for blog in blogs or ():
+            _index.add(blog)
+    logging.info('search.py: index synced: %s docs, %s reindexed, %s removed' % (len(_index), len(changed), len(removed)))
+
+@Blog.listen
+def _on_blog_change(event, blog):
+    if event == 'remove':
+        _index.remove(blog.id)
+    else:
+        _index.add(blog)
+
+async def _autosave(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await save_snapshot()
+        except Exception as e:
+            logging.exception(e)
+
+async def init(app, snapshot=None, interval=60):
+    '''
+    Load the snapshot, sync it with the database and keep saving it every interval seconds.
+    '''
+    global _index, _snapshot
+    _snapshot = snapshot or _default_snapshot()
+    _index = load_snapshot(_snapshot)
+    await sync()
+    await save_snapshot()
+    task = asyncio.ensure_future(_autosave(interval))
+
+    async def on_shutdown(app):
+        task.cancel()
+        await save_snapshot()
+    app.on_shutdown.append(on_shutdown)
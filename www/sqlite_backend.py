@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Embedded SQLite stand-in for MySQL, used by bench.py to run the app without a database server.
+
+    backend = SQLiteBackend()
+    backend.create_tables(User, Blog, Comment)
+    orm.use_backend(backend)
+
+Statements use the same '?' placeholders and backquoted names as the MySQL path. Queries run
+synchronously on the event loop, which is fine for an in-memory database.
+'''
+
+import logging, sqlite3, zlib
+
+def _crc32(s):
+    if s is None:
+        return None
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return zlib.crc32(s)
+
+def _concat_ws(sep, *args):
+    return sep.join(str(a) for a in args if a is not None)
+
+def _dict_factory(cursor, row):
+    return dict(zip([d[0] for d in cursor.description], row))
+
+
+class SQLiteBackend(object):
+
+    dialect = 'sqlite'
+
+    def __init__(self, path=':memory:'):
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.row_factory = _dict_factory
+        # MySQL里有、SQLite里没有的函数
+        self._conn.create_function('crc32', 1, _crc32)
+        self._conn.create_function('concat_ws', -1, _concat_ws)
+
+    def create_tables(self, *models):
+        for model in models:
+            columns = []
+            for name, field in model.__mappings__.items():
+                column = '`%s` %s' % (name, field.column_type)
+                if field.primary_key:
+                    column += ' primary key'
+                columns.append(column)
+            self._conn.execute('create table if not exists `%s` (%s)' % (model.__table__, ', '.join(columns)))
+            logging.info('sqlite_backend.py: created table %s' % model.__table__)
+
+    async def select(self, sql, args, size=None, as_dict=True):
+        cur = self._conn.cursor()
+        if not as_dict:
+            cur.row_factory = None
+        cur.execute(sql, args or ())
+        if size:
+            return cur.fetchmany(size)
+        return cur.fetchall()
+
+    async def execute(self, sql, args):
+        return self._conn.execute(sql, args or ()).rowcount
+
+    async def executemany(self, sql, rows):
+        return self._conn.executemany(sql, rows).rowcount
+
+    def close(self):
+        self._conn.close()
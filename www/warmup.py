@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Warm the process up before the listener opens: open pool connections, compile templates,
+prime hot caches and send one synthetic request through every GET route.
+app['__ready__'] is set when done, /readyz reports it to the load balancer.
+'''
+
+import logging, re, time
+
+from aiohttp.test_utils import make_mocked_request
+
+import handlers, orm
+
+_RE_PARAM = re.compile(r'\{(\w+)\}')
+
+def compile_templates(app):
+    env = app['__templating__']
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+async def prime_caches():
+    blogs = await handlers.recent_blogs()
+    await handlers.blog_count()
+    return blogs
+
+async def request_routes(app, params):
+    '''
+    Call the handler chain of every GET route with a mocked request, return the number called.
+    Routes with a path parameter not in params are skipped.
+    '''
+    n = 0
+    for route in app.router.routes():
+        if route.method != 'GET':
+            continue
+        info = route.get_info()
+        path = info.get('path') or info.get('formatter')
+        # 静态文件等没有path的route
+        if path is None:
+            continue
+        names = _RE_PARAM.findall(path)
+        if any(name not in params for name in names):
+            continue
+        match_info = dict((name, str(params[name])) for name in names)
+        path = _RE_PARAM.sub(lambda m: match_info[m.group(1)], path)
+        try:
+            await route.handler(make_mocked_request('GET', path, headers={handlers.WARMUP_HEADER: '1'}, app=app, match_info=match_info))
+            n += 1
+        except Exception as e:
+            logging.warning('warmup.py: GET %s failed: %s' % (path, e))
+    return n
+
+async def run(app, pool_size=5, routes=True):
+    start = time.time()
+    app['__ready__'] = False
+    conns = await orm.warm_pool(pool_size)
+    templates = compile_templates(app)
+    blogs = await prime_caches()
+    called = 0
+    if routes:
+        params = dict(id=blogs[0].id) if blogs else dict()
+        called = await request_routes(app, params)
+    app['__ready__'] = True
+    logging.info('warmup.py: ready in %.3f s: %s connections, %s templates, %s routes' % (time.time() - start, conns, templates, called))